@@ -25,10 +25,12 @@ Updates:
     png files sitting within /stimulus folder
 """
 from psychopy import visual, core, event, gui, data
-from random import sample, randint, shuffle, seed
-import pandas as pd
+from collections import defaultdict, namedtuple
+import csv
+import os
+import pickle
 import numpy as np
-seed()
+rng = np.random.default_rng()
 
 ### Functions ##################################################################
 def generate_isi(n_trials, min_frames, max_frames, chunk):
@@ -62,14 +64,25 @@ def generate_isi(n_trials, min_frames, max_frames, chunk):
     if (max_frames - min_frames) % 2 != 0:
         raise ValueError('mean number of frames should be an integer')
 
-    frames = [min_frames for _ in range(n_trials)]
+    # Each trial can be extended by at most max_steps chunks, and n_steps
+    # chunks have to be distributed across all trials
+    max_steps = (max_frames - min_frames) // chunk
     remaining_frames = int(n_trials * (max_frames - min_frames) / 2)
-    while remaining_frames > 0:
-        ind = randint(0, n_trials - 1)
-        if frames[ind] + chunk <= max_frames:
-            frames[ind] += chunk
-            remaining_frames -= chunk
-    frames = np.array(frames)
+    n_steps = -(-remaining_frames // chunk)
+
+    # Chunks are added one by one to randomly chosen trials and draws hitting
+    # already full trial are rejected. Draws are generated in batches; a draw
+    # is accepted if its trial has been drawn at most max_steps times so far.
+    draws = np.empty(0, dtype=np.int64)
+    while True:
+        draws = np.concatenate((draws, rng.integers(0, n_trials, 2 * n_steps)))
+        onehot = draws[:, None] == np.arange(n_trials)
+        occurrence = np.cumsum(onehot, axis=0)[np.arange(draws.size), draws]
+        accepted = draws[occurrence <= max_steps]
+        if accepted.size >= n_steps:
+            break
+    steps = np.bincount(accepted[:n_steps], minlength=n_trials)
+    frames = min_frames + steps * chunk
     return frames
 
 def generate_onsets(isi_seconds, time_block, time_info, n_trials):
@@ -78,32 +91,37 @@ def generate_onsets(isi_seconds, time_block, time_info, n_trials):
     and digit events.
 
     Parameters:
-        isi_seconds (list of np.array's): List of length equal to number of
-            blocks, each element contains np.array of length equal to number of
-            trials within block; elements of these arrays are isi in secondns.
+        isi_seconds (np.array): Array of shape (n_blocks, n_trials) with isi
+            in seconds for every trial of every block.
         time_block (float): Block duration in seconds.
         time_info (float): Duration in seconds of instruction screen displayed
             before eachblock.
         n_trials (int): Number of trials per block.
 
     Returns:
-        onset_fix (list of np.array's): Contains onset times for fixation
-            events. It's entries correspond to isi_seconds entries.
-        onset_dig (list of np.array's): Contains onset times for digit events.
-            It's entries correspond to isi_seconds entries.
+        onset_fix (np.array): Array of shape (n_blocks, n_trials) containing
+            onset times for fixation events. It's entries correspond to
+            isi_seconds entries.
+        onset_dig (np.array): Array of shape (n_blocks, n_trials) containing
+            onset times for digit events. It's entries correspond to
+            isi_seconds entries.
     '''
-    onset_fix, onset_dig = [], []
-
-    for idb, isi_dur in enumerate(isi_seconds):
-        # Time padding added before each block
-        padding = time_info * (idb + 1) + time_block * idb
-        # Cumulated and shifted isi
-        isi_cum = np.concatenate(([0], np.cumsum(isi_dur)[:-1]))
-        # Cumulated digit time
-        dig_cum = np.arange(0, time_digit * n_trials, time_digit)
-
-        onset_fix.append(isi_cum + dig_cum + padding)
-        onset_dig.append(isi_cum + dig_cum + isi_dur + padding)
+    isi_seconds = np.asarray(isi_seconds)
+    n_blocks = isi_seconds.shape[0]
+
+    # Time padding added before each block
+    padding = time_info * np.arange(1, n_blocks + 1) \
+            + time_block * np.arange(n_blocks)
+    # Cumulated and shifted isi (written into separate array, in-place cumsum
+    # is much slower)
+    isi_cum = np.empty(isi_seconds.shape, dtype=np.float64)
+    isi_cum[:, 0] = 0
+    np.cumsum(isi_seconds[:, :-1], axis=1, out=isi_cum[:, 1:])
+    # Cumulated digit time
+    dig_cum = np.arange(n_trials) * time_digit
+
+    onset_fix = isi_cum + dig_cum + padding[:, None]
+    onset_dig = onset_fix + isi_seconds
 
     return onset_fix, onset_dig
 
@@ -135,13 +153,102 @@ def frames2seconds(frames, refresh_rate):
 def save_pulses(pulses, filename):
     '''Saves pulse onsets and spacing between them into csv file'''
     if pulses:
-        puldur = [p1-p2 for p1, p2 in zip(pulses[1:], pulses[:-1])]
-        puldur = [0] + puldur
-        df = pd.DataFrame(
-            {'onset': pulses,
-             'spacing': puldur})
-        df.index = np.arange(1, len(df)+1)
-        df.to_csv(filename + '_pulse.csv', sep=",", columns=['onset','spacing'])
+        with open(filename + '_pulse.csv', 'w', newline='') as f:
+            writer = csv.writer(f, delimiter=',', lineterminator='\n')
+            writer.writerow(['', 'onset', 'spacing'])
+            prev = pulses[0]
+            for i, pulse in enumerate(pulses, start=1):
+                writer.writerow([i, pulse, pulse - prev])
+                prev = pulse
+
+def wait_until(clock, deadline, refresh_rate):
+    '''Waits till deadline without flipping the screen. Time is spent in frame
+    long core.wait steps. Each step ends with short CPU hogging period, during
+    which core.wait dispatches window events, so global keys (scanner pulses,
+    quit) are handled every frame.
+
+    Parameters:
+        clock (core.Clock): Clock used for measuring deadline.
+        deadline (float): End of waiting in seconds.
+        refresh_rate (int): Screen refresh rate in Hz.
+    '''
+    frame = 1 / refresh_rate
+    while clock.getTime() < deadline:
+        core.wait(
+            min(frame, deadline - clock.getTime()),
+            hogCPUperiod=0.002)
+
+def wait_static(stim, win, clock, deadline, refresh_rate):
+    '''Displays static stimulus till deadline. Stimulus is flipped once and
+    remaining time is spent in wait_until. Stimulus is flipped again one frame
+    before deadline, so that the next event is displayed on time.
+
+    Parameters:
+        stim (visual stimulus): Stimulus displayed on the screen.
+        win (visual.Window): Window used for displaying.
+        clock (core.Clock): Clock used for measuring deadline.
+        deadline (float): Time of next event onset in seconds.
+        refresh_rate (int): Screen refresh rate in Hz.
+    '''
+    stim.draw(); win.flip()
+    wait_until(clock, deadline - 1/refresh_rate, refresh_rate)
+    stim.draw(); win.flip()
+
+def flush_trials(exp, trial_buffer, start, stop):
+    '''Passes buffered trial data to ExperimentHandler. Each buffered trial
+    becomes separate entry containing trial parameters and collected data.
+
+    Parameters:
+        exp (data.ExperimentHandler): Handler receiving data.
+        trial_buffer (np.array): Structured array with one row per trial; the
+            'trial' field holds trial parameters (Trial namedtuple), remaining
+            fields hold data collected during the trial.
+        start (int): Index of first row to pass.
+        stop (int): Index after last row to pass.
+
+    Returns:
+        stop (int): Index of first row not passed yet.
+    '''
+    data_names = [name for name in trial_buffer.dtype.names
+                  if name not in ('trial', 'trial_idx')]
+    for row in trial_buffer[start:stop]:
+        for name, value in row['trial']._asdict().items():
+            exp.addData(name, value)
+        # Loop columns previously added by sequential TrialHandler (nReps=1)
+        idx = row['trial_idx'].item()
+        exp.addData('trials.thisRepN', 0)
+        exp.addData('trials.thisTrialN', idx)
+        exp.addData('trials.thisN', idx)
+        exp.addData('trials.thisIndex', idx)
+        for name in data_names:
+            value = row[name].item()
+            # Empty response is stored for trials without key press
+            if name == 'response' and value == '':
+                value = None
+            exp.addData(name, value)
+        exp.nextEntry()
+    return stop
+
+def save_buffered_trials():
+    '''Passes trials not yet passed to ExperimentHandler.'''
+    global n_flushed
+    n_flushed = flush_trials(exp, trial_buffer, n_flushed, bi)
+
+def quit_task():
+    '''Saves buffered trials (once experiment handler exists) and quits, so
+    that trials of unfinished block are kept.'''
+    if exp is not None:
+        save_buffered_trials()
+    core.quit()
+
+def print_trials(log_buffer):
+    '''Prints informations for researcher about trials collected in
+    log_buffer as (digit_l, digit_c, digit_r, correct, rt, keypressed) tuples
+    and empties the buffer.'''
+    print(''.join(
+        f'<> {l} {c} {r} <>\nCorrect={correct}, RT={rt:.3f}, keys={keys}\n'
+        for l, c, r, correct, rt, keys in log_buffer), end='')
+    log_buffer.clear()
 
 def getpulse():
     '''Collecting scanner pulses'''
@@ -177,6 +284,17 @@ key_left = 'a' # Response: no
 key_pulse = 's'
 key_quit = 'q'
 
+# Correctness of response given (condition, key, is_target or |is_order|)
+correct_map = {
+    ('control', key_right, 1): 1,
+    ('control', key_right, 0): 0,
+    ('control', key_left, 1): 0,
+    ('control', key_left, 0): 1,
+    ('order', key_right, 1): 1,
+    ('order', key_right, 0): 0,
+    ('order', key_left, 1): 0,
+    ('order', key_left, 0): 1}
+
 # Timing (in seconds)
 time_digit = 2
 time_info = 4
@@ -187,10 +305,11 @@ n_block = 4
 n_trials = 12
 
 ### Global keys ################################################################
+exp = None # Created (after trial buffer) when subject info is collected
 event.globalKeys.clear()
 event.globalKeys.add(
     key=key_quit,
-    func=core.quit)
+    func=quit_task)
 event.globalKeys.add(
     key=key_pulse,
     func=getpulse,
@@ -198,9 +317,6 @@ event.globalKeys.add(
 
 ### Task structure #############################################################
 # Randomize intervals (measured as number of frames)
-n_refresh_info = seconds2frames(
-    time=time_info,
-    refresh_rate=refresh_rate)
 n_chunk_isi = seconds2frames(
     time=time_chunk_isi,
     refresh_rate=refresh_rate)
@@ -208,29 +324,72 @@ n_range_isi = [seconds2frames(
     time=time,
     refresh_rate=refresh_rate)
     for time in time_range_isi]
-isi = [generate_isi(n_trials=n_trials, chunk=n_chunk_isi,
+isi = np.array([generate_isi(n_trials=n_trials, chunk=n_chunk_isi,
                     min_frames=n_range_isi[0], max_frames=n_range_isi[1])
-                    for _ in range(2 * n_block)]
+                    for _ in range(2 * n_block)])
 
 # Calculate fixed onsets of all task events (v3.2)
 time_block = n_trials * (np.mean(time_range_isi) + time_digit) # Block duration
-isi_seconds = [frames2seconds(isi_block, refresh_rate) for isi_block in isi]
+isi_seconds = frames2seconds(isi, refresh_rate)
 onset_fix, onset_dig = generate_onsets(
     isi_seconds=isi_seconds,
     time_block=time_block,
     time_info=time_info,
     n_trials=n_trials)
 
-# Import stimuli from file
-stim = data.importConditions(path_stim, returnFieldNames=False)
+# Import stimuli from file (parsed stimuli are cached next to the file and
+# reused as long as the file is not modified)
+path_stim_cache = path_stim + '.pkl'
+if os.path.isfile(path_stim_cache) \
+        and os.path.getmtime(path_stim_cache) >= os.path.getmtime(path_stim):
+    with open(path_stim_cache, 'rb') as f:
+        stim = pickle.load(f)
+else:
+    stim = data.importConditions(path_stim, returnFieldNames=False)
+    try:
+        with open(path_stim_cache, 'wb') as f:
+            pickle.dump(stim, f)
+    except OSError:
+        pass # Stimuli folder is not writable, parsed stimuli are used anyway
+
+# Group stimuli by block
+stim_by_block = defaultdict(list)
+for row in stim:
+    stim_by_block[row['block']].append(row)
+
+# Trial parameters: stimuli file columns extended with planned timing
+Trial = namedtuple(
+    'Trial',
+    list(stim[0].keys())
+    + ['isi_seconds', 'onset_fix_plan', 'onset_dig_plan', 'condition'])
 
 # Randomize block order for both conditions
-blorder_o = sample([i for i in range(1, n_block + 1)], n_block)
-blorder_c = sample([i for i in range(1, n_block + 1)], n_block)
+blorder_o = rng.permutation(np.arange(1, n_block + 1)).tolist()
+blorder_c = rng.permutation(np.arange(1, n_block + 1)).tolist()
 
 # Scanner pulses
 pulses = []
 
+# Trial data collected during blocks and passed to ExperimentHandler between
+# blocks (keypressed is stored as empty string when there is no response and
+# passed to ExperimentHandler as None)
+trial_dtype = np.dtype([
+    ('trial', 'O'),
+    ('trial_idx', 'i4'),
+    ('onset_fix', 'f8'),
+    ('onset_fix_glob', 'f8'),
+    ('onset_dig', 'f8'),
+    ('onset_dig_glob', 'f8'),
+    ('rt', 'f8'),
+    ('correct', 'i1'),
+    ('response', 'U4')])
+trial_buffer = np.empty(2 * n_block * n_trials, dtype=trial_dtype)
+bi = 0 # Next free row of trial_buffer
+n_flushed = 0 # Rows already passed to ExperimentHandler
+
+# Informations for researcher printed between blocks
+log_buffer = []
+
 ### Objects ####################################################################
 mywin = visual.Window(
     size=win_size,
@@ -247,24 +406,18 @@ fix = visual.TextStim(
     pos=[0, 0],
     color=text_color,
     height=text_fix_height)
-digit_l = visual.TextStim(
-    win=mywin,
-    text='',
-    pos=[-digit_separation, 0],
-    color=text_color,
-    height=digit_height)
-digit_r = visual.TextStim(
-    win=mywin,
-    text='',
-    pos=[digit_separation, 0],
-    color=text_color,
-    height=digit_height)
-digit_c = visual.TextStim(
-    win=mywin,
-    text='',
-    pos=[0, 0],
-    color=text_color,
-    height=digit_height)
+# Digits are prepared once for every value present in stimuli file, so that
+# text is never re-rendered during the task
+digit_stims = {}
+for side, x in [('l', -digit_separation), ('c', 0), ('r', digit_separation)]:
+    digit_stims[side] = {
+        digit: visual.TextStim(
+            win=mywin,
+            text=digit,
+            pos=[x, 0],
+            color=text_color,
+            height=digit_height)
+        for digit in {str(row['digit_' + side]) for row in stim}}
 text_center = visual.TextStim(
     win=mywin,
     text='',
@@ -304,6 +457,13 @@ exp = data.ExperimentHandler(
     dataFileName=filename,
     extraInfo={'subject_id': subject_id})
 
+# Draw every stimulus once into cleared back buffer, so that textures and
+# shaders are prepared before the task instead of during first trials
+for visual_stim in [fix, text_center, instr] \
+        + [s for side in digit_stims.values() for s in side.values()]:
+    visual_stim.draw()
+mywin.clearBuffer()
+
 # Ask participant for readiness
 text_center.setText('Gdy będziesz gotowy(-wa) naciśnij dowolny przycisk.')
 text_center.draw(); mywin.flip()
@@ -325,60 +485,68 @@ for block in range(n_block):
     for condition in ['control','order']:
         idb += 1
 
-        print(f'\nStarting {block + 1} {condition} block...\n')
-
         ### Info screen ########################################################
         if condition =='control':   instr.setImage(path_instr_con)
         else:                       instr.setImage(path_instr_ord)
 
-        exp.addData('onset_info', fmri_clock.getTime())
-        exp.addData('onset_info_glob', glob_clock.getTime())
-        exp.nextEntry()
+        onset_info = fmri_clock.getTime()
+        onset_info_glob = glob_clock.getTime()
         instr.draw(); mywin.flip()
 
+        # Static info screen time is used for saving data and block preparation
+        print_trials(log_buffer)
+        print(f'\nStarting {block + 1} {condition} block...\n')
+
+        # Save previous block before info entry of this block
+        n_flushed = flush_trials(exp, trial_buffer, n_flushed, bi)
+        exp.addData('onset_info', onset_info)
+        exp.addData('onset_info_glob', onset_info_glob)
+        exp.nextEntry()
+
         ### Trial loop creation (may take a while) #############################
         if condition == 'control':  blorder = blorder_c[block]
         else:                       blorder = blorder_o[block]
 
-        trialList = [row for row in stim if row['block'] == blorder]
-        shuffle(trialList)
-        trials = data.TrialHandler(
-            trialList=trialList,
-            nReps=1,
-            method='sequential')
+        trialList = list(stim_by_block[blorder])
+        rng.shuffle(trialList)
+        # zip below would silently drop trials without planned onsets
+        assert len(trialList) == n_trials, \
+            f'block {blorder} has {len(trialList)} trials, expected {n_trials}'
 
         # Set onsets
-        for idx, trial in enumerate(trials.trialList):
-            trial.update({'isi_seconds': isi_seconds[idb][idx]})
-            trial.update({'onset_fix_plan': onset_fix[idb][idx]})
-            trial.update({'onset_dig_plan': onset_dig[idb][idx]})
-            trial.update({'condition': condition})
-
-        # Pin existing loop to ExperimentHandler
-        exp.addLoop(trials)
+        trials = [
+            Trial(**row,
+                  isi_seconds=isi_trial,
+                  onset_fix_plan=onset_fix_trial,
+                  onset_dig_plan=onset_dig_trial,
+                  condition=condition)
+            for row, isi_trial, onset_fix_trial, onset_dig_trial in zip(
+                trialList, isi_seconds[idb], onset_fix[idb], onset_dig[idb])]
 
         # Wait till the end of info screen time
-        while fmri_clock.getTime() < onset_fix[idb][0]:
-            instr.draw(); mywin.flip()
+        wait_static(instr, mywin, fmri_clock, onset_fix[idb][0], refresh_rate)
 
         # Begin block
-        for thisTrial in trials:
+        for idx, thisTrial in enumerate(trials):
+            row = trial_buffer[bi]
+            row['trial'] = thisTrial
+            row['trial_idx'] = idx
 
             ### fixation #######################################################
-            exp.addData('onset_fix', fmri_clock.getTime())
-            exp.addData('onset_fix_glob', glob_clock.getTime())
+            row['onset_fix'] = fmri_clock.getTime()
+            row['onset_fix_glob'] = glob_clock.getTime()
 
-            while fmri_clock.getTime() < thisTrial['onset_dig_plan']:
-                fix.draw()
-                mywin.flip()
+            onset_dig_plan = thisTrial.onset_dig_plan
+            wait_static(fix, mywin, fmri_clock, onset_dig_plan, refresh_rate)
 
             ### digits #########################################################
-            digit_l.setText(text=thisTrial['digit_l']); digit_l.draw()
-            digit_r.setText(text=thisTrial['digit_r']); digit_r.draw()
-            digit_c.setText(text=thisTrial['digit_c']); digit_c.draw()
+            digit_l = digit_stims['l'][str(thisTrial.digit_l)]
+            digit_r = digit_stims['r'][str(thisTrial.digit_r)]
+            digit_c = digit_stims['c'][str(thisTrial.digit_c)]
+            digit_l.draw(); digit_r.draw(); digit_c.draw()
 
-            trials.addData('onset_dig', fmri_clock.getTime())
-            trials.addData('onset_dig_glob', glob_clock.getTime())
+            row['onset_dig'] = fmri_clock.getTime()
+            row['onset_dig_glob'] = glob_clock.getTime()
             rt_onset = fmri_clock.getTime() # For RT calculation
 
             mywin.flip()
@@ -389,53 +557,41 @@ for block in range(n_block):
                 timeStamped=fmri_clock,
                 clearEvents=True)
 
-            while fmri_clock.getTime() < thisTrial['onset_dig_plan']+time_digit:
-                digit_l.draw()
-                digit_r.draw()
-                digit_c.draw()
-                mywin.flip()
+            # Digits stay on screen till the end of digit time
+            wait_until(fmri_clock, onset_dig_plan + time_digit, refresh_rate)
 
             ### analyze response ###############################################
             if response == None:
                 rt = 0
                 correct = -1
                 keypressed = None
-            elif response[0][0] == key_right:
-                keypressed = key_right
-                if condition == 'control':
-                    correct = int(thisTrial['is_target'] == 1)
-                    rt = response[0][1] - rt_onset
-                else: #condition == 'order':
-                    correct = int(abs(thisTrial['is_order']) == 1)
-                    rt = response[0][1] - rt_onset
-            elif response[0][0] == key_left:
-                keypressed = key_left
-                if condition == 'control':
-                    correct = int(thisTrial['is_target'] == 0)
-                    rt = response[0][1] - rt_onset
-                else: #condition == 'order':
-                    correct = int(thisTrial['is_order'] == 0)
-                    rt = response[0][1] - rt_onset
-
-            # Save responses in TrialHandler
-            trials.addData('rt', rt)
-            trials.addData('correct', correct)
-            trials.addData('response', keypressed)
-            exp.nextEntry()
+            else:
+                keypressed = response[0][0]
+                if condition == 'control':  shown = thisTrial.is_target
+                else:                       shown = abs(thisTrial.is_order)
+                correct = correct_map.get((condition, keypressed, shown), 0)
+                rt = response[0][1] - rt_onset
+
+            # Save responses in trial buffer
+            row['rt'] = rt
+            row['correct'] = correct
+            row['response'] = keypressed or ''
+            bi += 1
 
             # Informations for researcher
-            print(f'<> {thisTrial["digit_l"]} {thisTrial["digit_c"]} {thisTrial["digit_r"]} <>')
-            print(f'Correct={correct}, RT={rt:.3f}, keys={keypressed}')
+            log_buffer.append((thisTrial.digit_l, thisTrial.digit_c,
+                               thisTrial.digit_r, correct, rt, keypressed))
 
 # 'Thank you' screen after task
 text_center.setText('Dziękujemy za udział w badaniu!')
-for frame in range(n_refresh_info):
-    text_center.draw()
-    mywin.flip()
+wait_static(text_center, mywin, fmri_clock, fmri_clock.getTime() + time_info,
+            refresh_rate)
+print_trials(log_buffer)
 print('\nTask ended. Saving logs.')
 
 ### Save data ##################################################################
 # Behavioral part
+save_buffered_trials()
 exp.saveAsWideText(
     fileName=filename,
     delim=',')
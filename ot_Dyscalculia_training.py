@@ -16,7 +16,11 @@ Author: Kamil Bonna (bonna@doktorant.umk.pl)
 Version: t.3.3
 """
 from psychopy import visual, core, event, gui, data
-from random import sample, shuffle
+from collections import defaultdict
+import os
+import pickle
+import numpy as np
+rng = np.random.default_rng()
 
 ### Settings ###################################################################
 # Window (screen)
@@ -48,6 +52,17 @@ key_right = 'm' # Response: yes
 key_left = 'z' # Response: no
 key_quit = 'q'
 
+# Correctness of response given (condition, key, is_target or |is_order|)
+correct_map = {
+    ('control', key_right, 1): 1,
+    ('control', key_right, 0): 0,
+    ('control', key_left, 1): 0,
+    ('control', key_left, 0): 1,
+    ('order', key_right, 1): 1,
+    ('order', key_right, 0): 0,
+    ('order', key_left, 1): 0,
+    ('order', key_left, 0): 1}
+
 # Timing (in seconds)
 time_fix = 4
 time_info = 4
@@ -61,12 +76,29 @@ event.globalKeys.add(
     func=core.quit)
 
 ### Task structure #############################################################
-# Import stimuli from file
-stim = data.importConditions(path_stim, returnFieldNames=False)
+# Import stimuli from file (parsed stimuli are cached next to the file and
+# reused as long as the file is not modified)
+path_stim_cache = path_stim + '.pkl'
+if os.path.isfile(path_stim_cache) \
+        and os.path.getmtime(path_stim_cache) >= os.path.getmtime(path_stim):
+    with open(path_stim_cache, 'rb') as f:
+        stim = pickle.load(f)
+else:
+    stim = data.importConditions(path_stim, returnFieldNames=False)
+    try:
+        with open(path_stim_cache, 'wb') as f:
+            pickle.dump(stim, f)
+    except OSError:
+        pass # Stimuli folder is not writable, parsed stimuli are used anyway
+
+# Group stimuli by block
+stim_by_block = defaultdict(list)
+for row in stim:
+    stim_by_block[row['block']].append(row)
 
 # Randomize block order for both conditions
-blorder_o = sample([i for i in range(1, 3)], 2)
-blorder_c = sample([i for i in range(1, 3)], 2)
+blorder_o = rng.permutation(np.arange(1, 3)).tolist()
+blorder_c = rng.permutation(np.arange(1, 3)).tolist()
 
 ### Dialogue box ###############################################################
 dlg = gui.Dlg(title="Order Task Training")
@@ -99,24 +131,18 @@ fix = visual.TextStim(
     pos=[0, 0],
     color=text_color,
     height=text_fix_height)
-digit_l = visual.TextStim(
-    win=mywin,
-    text='',
-    pos=[-digit_separation, 0],
-    color=text_color,
-    height=digit_height)
-digit_r = visual.TextStim(
-    win=mywin,
-    text='',
-    pos=[digit_separation, 0],
-    color=text_color,
-    height=digit_height)
-digit_c = visual.TextStim(
-    win=mywin,
-    text='',
-    pos=[0, 0],
-    color=text_color,
-    height=digit_height)
+# Digits are prepared once for every value present in stimuli file, so that
+# text is never re-rendered during the task
+digit_stims = {}
+for side, x in [('l', -digit_separation), ('c', 0), ('r', digit_separation)]:
+    digit_stims[side] = {
+        digit: visual.TextStim(
+            win=mywin,
+            text=digit,
+            pos=[x, 0],
+            color=text_color,
+            height=digit_height)
+        for digit in {str(row['digit_' + side]) for row in stim}}
 text_center = visual.TextStim(
     win=mywin,
     text='',
@@ -152,6 +178,13 @@ exp = data.ExperimentHandler(
     dataFileName=filename,
     extraInfo={'subject_id': subject_id})
 
+# Draw every stimulus once into cleared back buffer, so that textures and
+# shaders are prepared before the task instead of during first trials
+for visual_stim in [fix, text_center, instr, face_win, face_los] \
+        + [s for side in digit_stims.values() for s in side.values()]:
+    visual_stim.draw()
+mywin.clearBuffer()
+
 # Ask participant for readiness
 text_center.setText('Gdy będziesz gotowy(-wa) naciśnij dowolny przycisk.')
 text_center.draw(); mywin.flip()
@@ -175,7 +208,7 @@ for block in range(2):
         else:                       blorder = blorder_o[block]
 
         trials = data.TrialHandler(
-            trialList=[row for row in stim if row['block'] == blorder],
+            trialList=list(stim_by_block[blorder]),
             nReps=1,
             method='random')
 
@@ -195,9 +228,10 @@ for block in range(2):
                 fix.draw(); mywin.flip()
 
             ### digits #########################################################
-            digit_l.setText(text=thisTrial['digit_l']); digit_l.draw()
-            digit_r.setText(text=thisTrial['digit_r']); digit_r.draw()
-            digit_c.setText(text=thisTrial['digit_c']); digit_c.draw()
+            digit_l = digit_stims['l'][str(thisTrial['digit_l'])]
+            digit_r = digit_stims['r'][str(thisTrial['digit_r'])]
+            digit_c = digit_stims['c'][str(thisTrial['digit_c'])]
+            digit_l.draw(); digit_r.draw(); digit_c.draw()
             mywin.flip()
             timer.reset(t=time_digit)
 
@@ -207,30 +241,22 @@ for block in range(2):
                 timeStamped=timer,
                 clearEvents=True)
 
+            # Digits stay on screen till the end of digit time (short waits
+            # keep dispatching window events)
             while timer.getTime() > 0:
-                digit_l.draw(); digit_r.draw(); digit_c.draw(); mywin.flip()
+                core.wait(min(timer.getTime(), 0.01), hogCPUperiod=0.002)
 
             ### analyze response ###############################################
             if response == None:
                 rt = 0
                 correct = -1
                 keypressed = None
-            elif response[0][0] == key_right:
-                keypressed = key_right
-                if condition == 'control':
-                    correct = int(thisTrial['is_target'] == 1)
-                    rt = time_digit + response[0][1]
-                else: #condition == 'order':
-                    correct = int(abs(thisTrial['is_order']) == 1)
-                    rt = time_digit + response[0][1]
-            elif response[0][0] == key_left:
-                keypressed = key_left
-                if condition == 'control':
-                    correct = int(thisTrial['is_target'] == 0)
-                    rt = time_digit + response[0][1]
-                else: #condition == 'order':
-                    correct = int(thisTrial['is_order'] == 0)
-                    rt = time_digit + response[0][1]
+            else:
+                keypressed = response[0][0]
+                if condition == 'control':  shown = thisTrial['is_target']
+                else:                       shown = abs(thisTrial['is_order'])
+                correct = correct_map.get((condition, keypressed, shown), 0)
+                rt = time_digit + response[0][1]
 
             # Save responses in TrialHandler
             trials.addData('rt', rt)